@@ -1,13 +1,30 @@
+from .util import decimal_from_raw, raw_decimal
+
 class CurrencyPair:
     def __init__(self, /, id, code, scale):
         self.id = id
         self.code = code
         self.scale = scale
-        self.mark_price = None
+        # Mark price as an exact (value, scale) pair of ints,
+        # meaning value * 10**-scale, or None.
+        self.raw_mark_price = None
         self.sell_price = None
         self.buy_price = None
         self.unreliable = None
 
+    @property
+    def mark_price(self):
+        if self.raw_mark_price is None:
+            return None
+        return decimal_from_raw(*self.raw_mark_price)
+
+    @mark_price.setter
+    def mark_price(self, value):
+        if value is None:
+            self.raw_mark_price = None
+        else:
+            self.raw_mark_price = raw_decimal(value)
+
     def on_update(self):
         pass
 
@@ -2,14 +2,22 @@ from enum import Enum
 
 from digitex_engine_client import messages_pb2 as proto
 
+def _make_from_proto_table(enum, undefined=None):
+    # Proto enum values are small dense ints matching our values,
+    # so converting from proto is a plain tuple index.
+    table = [None] * (max(member.value for member in enum) + 1)
+    for member in enum:
+        table[member.value] = member
+    if undefined is not None:
+        table[undefined] = None
+    return tuple(table)
+
 class OrderType(Enum):
     MARKET = 1
     LIMIT = 2
 
     def from_proto(order_type):
-        if order_type == proto.TYPE_UNDEFINED:
-            return None
-        return OrderType(order_type)
+        return _ORDER_TYPE_TABLE[order_type]
 
     def to_proto(self):
         return self.value
@@ -20,16 +28,14 @@ class PositionType(Enum):
     SHORT = 2
 
     def from_proto(order_position):
-        return PositionType(order_position)
+        return _POSITION_TYPE_TABLE[order_position]
 
 class OrderSide(Enum):
     BUY = 1
     SELL = 2
 
     def from_proto(order_side):
-        if order_side == proto.SIDE_UNDEFINED:
-            return None
-        return OrderSide(order_side)
+        return _ORDER_SIDE_TABLE[order_side]
 
     def to_proto(self):
         return self.value
@@ -42,9 +48,7 @@ class OrderDuration(Enum):
     FOK = 5
 
     def from_proto(order_duration):
-        if order_duration == proto.DURATION_UNDEFINED:
-            return None
-        return OrderDuration(order_duration)
+        return _ORDER_DURATION_TABLE[order_duration]
 
     def to_proto(self):
         return self.value
@@ -61,9 +65,13 @@ class OrderStatus(Enum):
     TRIGGERED = 9
 
     def from_proto(order_status):
-        if order_status == proto.STATUS_UNDEFINED:
-            return None
-        return OrderStatus(order_status)
+        return _ORDER_STATUS_TABLE[order_status]
 
     def to_proto(self):
         return self.value
+
+_ORDER_TYPE_TABLE = _make_from_proto_table(OrderType, proto.TYPE_UNDEFINED)
+_POSITION_TYPE_TABLE = _make_from_proto_table(PositionType)
+_ORDER_SIDE_TABLE = _make_from_proto_table(OrderSide, proto.SIDE_UNDEFINED)
+_ORDER_DURATION_TABLE = _make_from_proto_table(OrderDuration, proto.DURATION_UNDEFINED)
+_ORDER_STATUS_TABLE = _make_from_proto_table(OrderStatus, proto.STATUS_UNDEFINED)
@@ -1,23 +1,101 @@
 import asyncio
+import logging
 from decimal import Decimal
 
 import uuid
 
+from digitex_engine_client import messages_pb2 as proto
+
 from .trader import Trader
 from .trade import Trade
-from .util import decimal_from_proto, datetime_from_proto, round_price
-from .enums import PositionType, OrderSide, OrderType, OrderDuration, OrderStatus
+from .util import decimal_from_proto, raw_decimal_from_proto, decimal_from_scaled_int, datetime_from_proto
+from .util import round_scaled_price
+from .enums import OrderStatus
+from .enums import _ORDER_TYPE_TABLE, _POSITION_TYPE_TABLE, _ORDER_SIDE_TABLE
+from .enums import _ORDER_DURATION_TABLE, _ORDER_STATUS_TABLE
 from .order_book import OrderBook, OrderBookEntry
 from .order import Order, Orders
 from .tick import Tick
 from .currency_pair import CurrencyPair
 
+logger = logging.getLogger('digitex_bot_framework')
+
+_POSITION_FIELDS = (
+    'position_contracts',
+    'position_volume',
+    'position_liquidation_volume',
+    'position_bankruptcy_volume',
+    'position_margin',
+)
+_ORDER_MARGIN_FIELDS = ('order_margin', 'buy_order_margin', 'sell_order_margin')
+_BALANCE_FIELDS = ('trader_balance', 'upnl', 'pnl')
+_LAST_TRADE_FIELDS = ('last_trade_price', 'last_trade_quantity')
+_TRADER_STATUS_FIELDS = _BALANCE_FIELDS + _ORDER_MARGIN_FIELDS + _POSITION_FIELDS
+
+# Orders in these statuses are kept in Orders.
+_STATUSES_TO_KEEP = (OrderStatus.ACCEPTED, OrderStatus.PARTIAL)
+
+def _message_types(descriptors):
+    for descriptor in descriptors:
+        yield descriptor
+        yield from _message_types(descriptor.nested_types)
+
+_MESSAGE_TYPES = tuple(_message_types(proto.DESCRIPTOR.message_types_by_name.values()))
+
+# Whether messages of a type have a status field, and whether the entries
+# of their repeated 'orders' field do, keyed by message descriptor. These
+# are worked out once from the schema instead of probing every message.
+_HAS_STATUS = {
+    descriptor: 'status' in descriptor.fields_by_name
+    for descriptor in _MESSAGE_TYPES
+}
+_ORDERS_HAVE_STATUS = {
+    descriptor: 'status' in descriptor.fields_by_name['orders'].message_type.fields_by_name
+    for descriptor in _MESSAGE_TYPES
+    if 'orders' in descriptor.fields_by_name
+    and descriptor.fields_by_name['orders'].message_type is not None
+}
+
+# Maps the name of the set 'kontent' oneof field to the name of its
+# handler, and whether the handler also wants the outer message. Handlers
+# are looked up by name on every message, so overriding them still works.
+_HANDLERS = {
+    'trader_status_msg': ('handle_trader_status_msg', False),
+    'trader_balance_msg': ('handle_trader_balance_msg', False),
+    'exchange_rate_msg': ('handle_exchange_rate_msg', False),
+    'order_book_msg': ('handle_order_book_msg', False),
+    'order_book_updated_msg': ('handle_order_book_updated_msg', False),
+    'order_status_msg': ('handle_order_status_msg', True),
+    'order_filled_msg': ('handle_order_status_msg', True),
+    'order_canceled_msg': ('handle_order_canceled_msg', True),
+    'leverage_msg': ('handle_leverage_msg', True),
+}
+
+def _decimals(message, field_names):
+    return [decimal_from_proto(message, field_name) for field_name in field_names]
+
 class Market:
     by_id = dict()
     by_name = dict()
     by_code = dict()
 
+    # How many coroutine event handlers run at once, and how many may wait
+    # for a worker before new ones get a task of their own instead.
+    event_concurrency = 8
+    event_queue_size = 1000
+
     def __init__(self, /, id, name, code, currency_pair, tick):
+        # Tick size in the currency pair's 10**-scale units.
+        self.scaled_tick_size = int(tick.size.scaleb(currency_pair.scale))
+        if (
+            self.scaled_tick_size <= 0 or
+            decimal_from_scaled_int(self.scaled_tick_size, currency_pair.scale) != tick.size
+        ):
+            raise ValueError(
+                f'Tick size {tick.size} is not a positive whole number '
+                f'of 10**-{currency_pair.scale} units'
+            )
+
         self.id = id
         self.name = name
         self.code = code
@@ -33,85 +111,142 @@ class Market:
         self.currency_pair = currency_pair
         self.tick = tick
         self.last_trade = None
+        # Raw timestamp, price and quantity of the last decoded trade.
+        self.last_trade_key = None
 
         self.order_type = Order
-        self.scheduled_events = []
+        # Used as an insertion-ordered set.
+        self.scheduled_events = dict()
+        # Coroutines returned by event handlers, awaited by a small pool
+        # of worker tasks that is started on first use.
+        self.event_queue = None
+        self.event_workers = []
 
     def __repr__(self):
         return f'Market(id={self.id}, name={self.name!r}, code={self.code!r})'
 
+    def rounded_scaled_spot_price(self, direction='closest'):
+        currency_pair = self.currency_pair
+        if currency_pair.raw_mark_price is None:
+            return None
+        value, scale = currency_pair.raw_mark_price
+        if scale <= currency_pair.scale:
+            price = value * 10 ** (currency_pair.scale - scale)
+            return round_scaled_price(price, self.scaled_tick_size, direction)
+        # The mark price is more precise than the pair's scale, so round
+        # it at its own scale; the result is still a whole number of ticks.
+        factor = 10 ** (scale - currency_pair.scale)
+        return round_scaled_price(value, self.scaled_tick_size * factor, direction) // factor
+
     def rounded_spot_price(self, direction='closest'):
-        spot_price = self.currency_pair.mark_price
-        return round_price(spot_price, self.tick.size, direction)
+        price = self.rounded_scaled_spot_price(direction)
+        if price is None:
+            return None
+        return decimal_from_scaled_int(price, self.currency_pair.scale).quantize(self.tick.size)
 
     def schedule_event(self, event):
-        if event not in self.scheduled_events:
-            self.scheduled_events.append(event)
+        self.scheduled_events[event] = None
 
     def emit_event(self, event):
         res = event()
         if res is None:
             return
         if asyncio.iscoroutine(res):
-            asyncio.create_task(res)
+            self.queue_event_coroutine(res)
             return
         raise TypeError('Unsupported event return type: ' + type(res))
 
+    def queue_event_coroutine(self, coro):
+        if self.event_queue is None:
+            self.event_queue = asyncio.Queue(maxsize=self.event_queue_size)
+        self.event_workers = [worker for worker in self.event_workers if not worker.done()]
+        while len(self.event_workers) < self.event_concurrency:
+            worker = asyncio.ensure_future(self.run_event_worker(self.event_queue))
+            self.event_workers.append(worker)
+        try:
+            self.event_queue.put_nowait(coro)
+        except asyncio.QueueFull:
+            logger.warning('Too many pending event handlers, not queueing')
+            asyncio.ensure_future(coro)
+
+    async def run_event_worker(self, queue):
+        try:
+            while True:
+                coro = await queue.get()
+                try:
+                    await coro
+                except Exception:
+                    logger.exception('Event handler failed')
+        except asyncio.CancelledError:
+            # If no other worker is left to await what's still queued,
+            # close it rather than leave it never awaited.
+            current = asyncio.current_task()
+            if all(worker.done() or worker is current for worker in self.event_workers):
+                while not queue.empty():
+                    queue.get_nowait().close()
+            raise
+
     def handle_message(self, message):
         which_one = message.WhichOneof('kontent')
-        if which_one == 'trader_status_msg':
-            self.handle_trader_status_msg(message.trader_status_msg)
-        elif which_one == 'trader_balance_msg':
-            self.handle_trader_balance_msg(message.trader_balance_msg)
-        elif which_one == 'exchange_rate_msg':
-            self.handle_exchange_rate_msg(message.exchange_rate_msg)
-        elif which_one == 'order_book_msg':
-            self.handle_order_book_msg(message.order_book_msg)
-        elif which_one == 'order_book_updated_msg':
-            self.handle_order_book_updated_msg(message.order_book_updated_msg)
-        elif which_one == 'order_status_msg':
-            self.handle_order_status_msg(message.order_status_msg, message)
-        elif which_one == 'order_filled_msg':
-            self.handle_order_status_msg(message.order_filled_msg, message)
-        elif which_one == 'order_canceled_msg':
-            self.handle_order_canceled_msg(message.order_canceled_msg, message)
-        elif which_one == 'leverage_msg':
-            self.handle_leverage_msg(message.leverage_msg, message)
+        entry = _HANDLERS.get(which_one)
+        if entry is not None:
+            handler_name, needs_outer_message = entry
+            handler = getattr(self, handler_name)
+            if needs_outer_message:
+                handler(getattr(message, which_one), message)
+            else:
+                handler(getattr(message, which_one))
         # else:
             # print('Unhandled message:')
             # print(message)
 
-        for event in self.scheduled_events:
+        events = self.scheduled_events
+        self.scheduled_events = dict()
+        for event in events:
             self.emit_event(event)
-        self.scheduled_events.clear()
 
     def handle_mark_price(self, message):
-        self.currency_pair.mark_price = decimal_from_proto(message, 'mark_price')
-        self.schedule_event(self.currency_pair.on_update)
+        currency_pair = self.currency_pair
+        currency_pair.raw_mark_price = raw_decimal_from_proto(message, 'mark_price')
+        self.schedule_event(currency_pair.on_update)
 
     def create_order_from_message(self, message, id):
         return self.order_type(
             price=decimal_from_proto(message, 'price'),
             quantity=decimal_from_proto(message, 'quantity'),
-            side=OrderSide.from_proto(message.side),
-            type=OrderType.from_proto(message.order_type),
-            duration=OrderDuration.from_proto(message.duration),
+            side=_ORDER_SIDE_TABLE[message.side],
+            type=_ORDER_TYPE_TABLE[message.order_type],
+            duration=_ORDER_DURATION_TABLE[message.duration],
             market=self,
             id=id,
         )
 
-    def handle_order(self, message, outer_message=None, forced_status=None):
-        if message.orig_client_id:
-            id = uuid.UUID(bytes=message.orig_client_id)
-        else:
-            id = uuid.UUID(bytes=outer_message.client_id)
-        order = self.trader.orders.look_up_by_id(id)
+    def handle_order(self, message, outer_message=None, forced_status=None, has_status=None):
+        # Callers that know the message type pass has_status, to avoid
+        # probing the message with hasattr() for every order.
+        if has_status is None:
+            has_status = hasattr(message, 'status')
+        orders = self.trader.orders
+        id_bytes = message.orig_client_id or outer_message.client_id
+        order = orders.look_up_by_id_bytes(id_bytes)
         have_seen_this_order_before = order is not None
+
+        if has_status:
+            status = _ORDER_STATUS_TABLE[message.status]
+            if (
+                have_seen_this_order_before and
+                status is order.status and
+                status in _STATUSES_TO_KEEP and
+                (outer_message is None or outer_message.error_code == 0)
+            ):
+                # The common case of an update for an order that's
+                # still open; there's nothing to change.
+                return order, True
         if not have_seen_this_order_before:
-            order = self.create_order_from_message(message, id)
+            order = self.create_order_from_message(message, uuid.UUID(bytes=id_bytes))
 
-        if hasattr(message, 'status'):
-            order.status = OrderStatus.from_proto(message.status)
+        if has_status:
+            order.status = status
         elif forced_status is not None:
             order.status = forced_status
         elif not have_seen_this_order_before:
@@ -123,11 +258,10 @@ class Market:
         if outer_message is not None and outer_message.error_code != 0:
             order.error_code = outer_message.error_code
 
-        statuses_to_keep = (OrderStatus.ACCEPTED, OrderStatus.PARTIAL)
-        if have_seen_this_order_before and order.status not in statuses_to_keep:
-            self.trader.orders.remove(order)
-        elif not have_seen_this_order_before and order.status in statuses_to_keep:
-            self.trader.orders.add(order)
+        if have_seen_this_order_before and order.status not in _STATUSES_TO_KEEP:
+            orders.remove(order)
+        elif not have_seen_this_order_before and order.status in _STATUSES_TO_KEEP:
+            orders.add(order)
 
         return order, have_seen_this_order_before
 
@@ -138,7 +272,11 @@ class Market:
             self.handle_position(message)
             self.handle_order_margin(message)
 
-        order, have_seen_this_order_before = self.handle_order(message, outer_message)
+        order, have_seen_this_order_before = self.handle_order(
+            message,
+            outer_message,
+            has_status=_HAS_STATUS.get(message.DESCRIPTOR),
+        )
         self.schedule_event(order.on_update)
 
     def handle_order_filled_message(self, message, outer_message):
@@ -146,7 +284,11 @@ class Market:
         self.handle_balance(message)
         self.handle_order_margin(message)
 
-        order, have_seen_this_order_before = self.handle_order(message, outer_message)
+        order, have_seen_this_order_before = self.handle_order(
+            message,
+            outer_message,
+            has_status=_HAS_STATUS.get(message.DESCRIPTOR),
+        )
         order.quantity = decimal_from_proto(message, 'orig_quantity')
         order.quantity -= decimal_from_proto(message, 'quantity')
         order.quantity -= decimal_from_proto(message, 'dropped_quantity')
@@ -161,13 +303,15 @@ class Market:
         self.trader.position.margin = decimal_from_proto(message, 'position_margin')
         self.schedule_event(self.trader.position.on_update)
 
-        status = OrderStatus.from_proto(message.status)
+        status = _ORDER_STATUS_TABLE[message.status]
+        has_status = _ORDERS_HAVE_STATUS.get(message.DESCRIPTOR)
 
         for order_msg in message.orders:
             order, have_seen_this_order_before = self.handle_order(
                 order_msg,
                 outer_message,
-                forced_status=status
+                forced_status=status,
+                has_status=has_status,
             )
             self.schedule_event(order.on_update)
 
@@ -180,29 +324,40 @@ class Market:
             self.handle_last_trade(message)
 
     def handle_last_trade(self, message):
+        timestamp = message.last_trade_timestamp
+        price = message.last_trade_price
+        quantity = message.last_trade_quantity
+        # Trades from one order filling several levels share a timestamp,
+        # so compare the price and quantity as well.
+        key = (timestamp, price.value64, price.scale, quantity.value64, quantity.scale)
         if self.last_trade is None:
             self.last_trade = Trade()
-        self.last_trade.price = decimal_from_proto(message, 'last_trade_price')
-        self.last_trade.quantity = decimal_from_proto(message, 'last_trade_quantity')
-        self.last_trade.time = datetime_from_proto(message.last_trade_timestamp)
+        elif key == self.last_trade_key:
+            # No new trades since we've last seen one.
+            return
+        self.last_trade_key = key
+        last_trade = self.last_trade
+        last_trade.price, last_trade.quantity = _decimals(message, _LAST_TRADE_FIELDS)
+        last_trade.time = datetime_from_proto(timestamp)
 
-        self.schedule_event(self.last_trade.on_update)
+        self.schedule_event(last_trade.on_update)
 
     def handle_position(self, message):
-        self.trader.position.contracts = decimal_from_proto(message, 'position_contracts')
-        self.trader.position.volume = decimal_from_proto(message, 'position_volume')
-        self.trader.position.liquidation_volume = decimal_from_proto(message, 'position_liquidation_volume')
-        self.trader.position.bankruptcy_volume = decimal_from_proto(message, 'position_bankruptcy_volume')
-        self.trader.position.type = PositionType.from_proto(message.position_type)
-        self.trader.position.margin = decimal_from_proto(message, 'position_margin')
-
-        self.schedule_event(self.trader.position.on_update)
+        position = self.trader.position
+        (
+            position.contracts,
+            position.volume,
+            position.liquidation_volume,
+            position.bankruptcy_volume,
+            position.margin,
+        ) = _decimals(message, _POSITION_FIELDS)
+        position.type = _POSITION_TYPE_TABLE[message.position_type]
+
+        self.schedule_event(position.on_update)
 
     def handle_order_margin(self, message):
         orders = self.trader.orders
-        orders.margin = decimal_from_proto(message, 'order_margin')
-        orders.buy_margin = decimal_from_proto(message, 'buy_order_margin')
-        orders.sell_margin = decimal_from_proto(message, 'sell_order_margin')
+        orders.margin, orders.buy_margin, orders.sell_margin = _decimals(message, _ORDER_MARGIN_FIELDS)
 
         self.schedule_event(orders.on_margins_update)
 
@@ -215,29 +370,30 @@ class Market:
         self.schedule_event(self.trader.on_update)
 
     def handle_balance(self, message):
-        self.trader.balance = decimal_from_proto(message, 'trader_balance')
-        self.trader.upnl = decimal_from_proto(message, 'upnl')
-        self.trader.pnl = decimal_from_proto(message, 'pnl')
-        # self.trader.accum_quantity = decimal_from_proto(message, 'accum_quantity')
-        self.schedule_event(self.trader.on_update)
+        trader = self.trader
+        trader.balance, trader.upnl, trader.pnl = _decimals(message, _BALANCE_FIELDS)
+        # trader.accum_quantity = decimal_from_proto(message, 'accum_quantity')
+        self.schedule_event(trader.on_update)
 
     def populate_orderbook(target, source):
         for proto_entry in source:
             entry = OrderBookEntry.from_proto(proto_entry)
-            if entry.quantity == 0 and entry.price in target:
-                del target[entry.price]
+            if entry.quantity == 0:
+                target.pop(entry.price, None)
             else:
                 target[entry.price] = entry
 
+    def load_orderbook(target, source):
+        # The target is empty here, so build it in one go instead of
+        # inserting level by level; this lets the sorted dict sort once.
+        from_proto = OrderBookEntry.from_proto
+        entries = [from_proto(proto_entry) for proto_entry in source]
+        target.update((entry.price, entry) for entry in entries if entry.quantity != 0)
+
     def handle_order_book_msg(self, message):
-        if self.order_book.bids is not None:
-            self.order_book.bids.clear()
-            self.order_book.asks.clear()
-        else:
-            self.order_book.bids = dict()
-            self.order_book.asks = dict()
-        Market.populate_orderbook(self.order_book.bids, message.bids)
-        Market.populate_orderbook(self.order_book.asks, message.asks)
+        self.order_book.reset()
+        Market.load_orderbook(self.order_book.bids, message.bids)
+        Market.load_orderbook(self.order_book.asks, message.asks)
 
         self.handle_last_trade(message)
         self.handle_mark_price(message)
@@ -252,7 +408,6 @@ class Market:
             asyncio.create_task(self.bot.client.order_book_request(market_id=self.id))
 
         self.handle_last_trade(message)
-        self.handle_last_trade(message)
 
     def handle_exchange_rate_msg(self, message):
         if message.currency_pair_id not in self.bot.currency_pairs:
@@ -261,7 +416,7 @@ class Market:
 
         # Note: this should not use handle_mark_price(), because we're
         # not necesserily updating this market's currency pair.
-        currency_pair.mark_price = decimal_from_proto(message, 'mark_price')
+        currency_pair.raw_mark_price = raw_decimal_from_proto(message, 'mark_price')
         currency_pair.sell_price = decimal_from_proto(message, 'sell_price')
         currency_pair.buy_price = decimal_from_proto(message, 'buy_price')
         currency_pair.unreliable = message.unreliable != 0
@@ -269,15 +424,36 @@ class Market:
         self.schedule_event(currency_pair.on_update)
 
     def handle_trader_status_msg(self, message):
-        self.handle_balance(message)
+        # Same as calling handle_balance(), handle_order_margin() and
+        # handle_position(), but decoding all of their fields in one go.
+        trader = self.trader
+        orders = trader.orders
+        position = trader.position
+        (
+            trader.balance,
+            trader.upnl,
+            trader.pnl,
+            orders.margin,
+            orders.buy_margin,
+            orders.sell_margin,
+            position.contracts,
+            position.volume,
+            position.liquidation_volume,
+            position.bankruptcy_volume,
+            position.margin,
+        ) = _decimals(message, _TRADER_STATUS_FIELDS)
+        position.type = _POSITION_TYPE_TABLE[message.position_type]
+
+        self.schedule_event(trader.on_update)
         self.handle_mark_price(message)
         self.handle_last_trade(message)
-        self.handle_order_margin(message)
-        self.handle_position(message)
+        self.schedule_event(orders.on_margins_update)
+        self.schedule_event(position.on_update)
         self.handle_leverage(message)
 
+        has_status = _ORDERS_HAVE_STATUS.get(message.DESCRIPTOR)
         for order_msg in message.orders:
-            order, have_seen_this_order_before = self.handle_order(order_msg)
+            order, have_seen_this_order_before = self.handle_order(order_msg, has_status=has_status)
             self.schedule_event(order.on_update)
 
     def handle_trader_balance_msg(self, message):
@@ -29,7 +29,7 @@ class Order:
 
     async def cancel(self):
         # Remove it from the list, but leave it in the
-        # by-id dictionary. We'll purge it from there
+        # by-id dictionaries. We'll purge it from those
         # once we receive acknowledgement from the engine.
         if self not in self.market.trader.orders:
             logger.warning('Trying to cancel inactive order %s', self)
@@ -54,6 +54,9 @@ class Orders(list):
     def __init__(self, /, market):
         self.market = market
         self.by_id = dict()
+        # Same orders, keyed by the raw 16 bytes of the id, as sent by
+        # the engine; this is what message handling looks orders up by.
+        self.by_id_bytes = dict()
 
         self.margin = None
         self.buy_margin = None
@@ -63,17 +66,25 @@ class Orders(list):
         pass
 
     def add(self, order):
-        assert order.id not in self.by_id
+        id_bytes = order.id.bytes
+        assert id_bytes not in self.by_id_bytes
         self.by_id[order.id] = order
+        self.by_id_bytes[id_bytes] = order
         self.append(order)
 
     def remove(self, order):
         del self.by_id[order.id]
+        del self.by_id_bytes[order.id.bytes]
         if order in self:
             super().remove(order)
 
     def look_up_by_id(self, id):
-        return self.by_id.get(id, None)
+        if isinstance(id, uuid.UUID):
+            id = id.bytes
+        return self.by_id_bytes.get(id, None)
+
+    def look_up_by_id_bytes(self, id_bytes):
+        return self.by_id_bytes.get(id_bytes, None)
 
     async def place(self, order):
         if order.market is None:
@@ -1,24 +1,39 @@
+from operator import neg
+
+from sortedcontainers import SortedDict
+
 from .util import decimal_from_proto, datetime_from_proto
 
 class OrderBook:
     def __init__(self):
+        # Both sides are kept sorted best price first.
         self.bids = None
         self.asks = None
 
+    def reset(self):
+        if self.bids is not None:
+            self.bids.clear()
+            self.asks.clear()
+        else:
+            self.bids = SortedDict(neg)
+            self.asks = SortedDict()
+
     def best_bid_price(self):
-        if self.bids is None:
+        if not self.bids:
             return None
-        return max(self.bids, default=None)
+        return self.bids.peekitem(0)[0]
 
     def best_ask_price(self):
-        if self.asks is None:
+        if not self.asks:
             return None
-        return min(self.asks, default=None)
+        return self.asks.peekitem(0)[0]
 
     def on_update(self):
         pass
 
 class OrderBookEntry:
+    __slots__ = ('price', 'quantity', 'entry_time')
+
     def from_proto(message):
         self = OrderBookEntry()
         self.price = decimal_from_proto(message, 'price')
@@ -30,9 +30,21 @@ def handle_explicit_field_name(f):
 def decimal_from_proto(proto_decimal):
     return Decimal(proto_decimal.value64).scaleb(-proto_decimal.scale)
 
-def decimal_to_proto(decimal):
-    if decimal is None:
+@handle_explicit_field_name
+def raw_decimal_from_proto(proto_decimal):
+    # The exact (value, scale) pair, without going through Decimal.
+    return proto_decimal.value64, proto_decimal.scale
+
+def decimal_from_raw(value, scale):
+    return Decimal(value).scaleb(-scale)
+
+def decimal_from_scaled_int(value, scale):
+    if value is None:
         return None
+    return Decimal(value).scaleb(-scale)
+
+def raw_decimal(decimal):
+    # The inverse of decimal_from_raw().
     if not isinstance(decimal, Decimal):
         decimal = Decimal(decimal)
     negative, digits, exponent = decimal.as_tuple()
@@ -42,7 +54,12 @@ def decimal_to_proto(decimal):
         value += digit
     if negative:
         value = -value
-    scale = -exponent
+    return value, -exponent
+
+def decimal_to_proto(decimal):
+    if decimal is None:
+        return None
+    value, scale = raw_decimal(decimal)
     return proto.Decimal(value64=value, scale=scale)
 
 def datetime_from_proto(timestamp):
@@ -68,6 +85,25 @@ def round_price(price, step, direction):
     else:
         raise ValueError('Unsupported rounding direction: ' + str(direction))
 
+def round_scaled_price(price, step, direction):
+    # Same as round_price(), but for integer prices and steps
+    # expressed in the same 10**-scale units.
+    if price is None:
+        return None
+    quotient, remainder = divmod(price, step)
+    if direction == 'down':
+        pass
+    elif direction == 'up':
+        quotient += 1
+    elif direction == 'closest':
+        # Break ties towards the even multiple, like remainder_near() does.
+        doubled = remainder * 2
+        if doubled > step or (doubled == step and quotient % 2 == 1):
+            quotient += 1
+    else:
+        raise ValueError('Unsupported rounding direction: ' + str(direction))
+    return quotient * step
+
 class CombineAsyncIterators:
     def __init__(self, *iters):
         self.iters = iters